@@ -10,17 +10,32 @@ The goal is to reduce noise to crypto, randomness, key/credential,
 PKI, cleartext, and password hashing related CWEs as specified.
 """
 
-from bs4 import BeautifulSoup
+import lxml.html
+from lxml.cssselect import CSSSelector
+from lxml.etree import ParserError
+from selectolax.lexbor import LexborHTMLParser
 import re
 import os
-import json
+import orjson
 import time
 import random
-from urllib.request import Request, urlopen
-from urllib.error import HTTPError, URLError
+from types import MappingProxyType
 from typing import Optional
-import subprocess
-from tqdm import tqdm, trange
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import aiohttp
+import backoff
+from aiohttp_client_cache import CachedSession, SQLiteBackend
+from tqdm import tqdm
+from tqdm.asyncio import tqdm as atqdm
+
+try:
+    import uvloop
+except ImportError:  # not available on Windows; fall back to the stock event loop
+    uvloop = None
 
 
 # Allowed CWE IDs (string of numbers) based on the provided categories
@@ -38,6 +53,58 @@ ALLOWED_CWE_IDS = {
     # Password hashing
     "759", "760", "916",
 }
+ALLOWED_CWE_INTS = {int(x) for x in ALLOWED_CWE_IDS}
+
+CWE_RE = re.compile(r"CWE-(\d+)")
+
+# Every lookup on Mend pages, kept in one place
+SELECTORS = {
+    # listing pages
+    "cve_a": "a[href^='/vulnerability-database/CVE']",
+    "pagination": "li.vuln-pagination-item",
+    # CVE detail pages
+    "cwe": "div.light-box a[href]",
+    "h4": "h4",
+    "refs": "div.reference-row a[href]",
+    "desc": "div.single-vuln-desc.no-good-to-know p",
+    "desc_fallback": "div.single-vuln-desc p",
+    "score": "div.ranger-value label",
+    "table": "table.table.table-report",
+    "tr": "tr",
+    "th": "th",
+    "td": "td",
+}
+# Listing pages are parsed with lxml, where selectors compile to XPath once, here.
+# Detail pages stay on lexbor, which is faster there but has no precompiled selectors.
+LISTING_SELECTORS = {name: CSSSelector(SELECTORS[name]) for name in ("cve_a", "pagination")}
+
+# Processes crawling months in parallel. Rates below are split across the ones
+# still running and concurrency caps are per process, so the aggregate stays polite.
+MONTH_WORKERS = 4
+# Max in-flight requests to www.mend.io, per process
+CONCURRENCY = 4
+# Max in-flight requests to api.github.com, per process
+GITHUB_CONCURRENCY = 4
+# Steady-state request rate (req/s) for www.mend.io, across all processes
+MEND_RATE = 10
+# Request rate (req/s) for api.github.com, across all processes, while quota lasts;
+# GitHub's secondary limit allows about 900 REST requests a minute
+GITHUB_RATE = 15
+# Below this many requests left in the hourly quota, GitHub calls are spread
+# evenly over the rest of the window instead
+GITHUB_RESERVE = 500
+# 200-OK Mend pages are served from an on-disk cache for a week, so re-runs
+# and retries do not download them again
+MEND_CACHE = "mend_cache.sqlite"
+MEND_CACHE_TTL = 7 * 24 * 3600
+# HTTP statuses worth retrying; anything else fails fast
+RETRY_STATUSES = (403, 429, 500, 502, 503, 504)
+
+GITHUB_TOKEN = os.environ.get("GITHUB_TOKEN")
+GITHUB_HEADERS = {
+    "X-GitHub-Api-Version": "2022-11-28",
+    "Accept": "application/vnd.github+json",
+}
 
 
 def ensure_dirs(paths):
@@ -45,278 +112,569 @@ def ensure_dirs(paths):
         os.makedirs(p, exist_ok=True)
 
 
+def last_line(path, chunk_size: int = 4096) -> bytes:
+    """Return the last non-empty line of a file, reading backwards from the end like `tail -n1`."""
+    with open(path, "rb") as f:
+        pos = f.seek(0, os.SEEK_END)
+        buf = b""
+        while pos > 0:
+            step = min(chunk_size, pos)
+            pos -= step
+            f.seek(pos)
+            buf = f.read(step) + buf
+            stripped = buf.rstrip(b"\r\n")
+            nl = stripped.rfind(b"\n")
+            if nl != -1:
+                return stripped[nl + 1:]
+        return buf.rstrip(b"\r\n")
+
+
+def resume_qid(path) -> int:
+    """Return the q_id of the last record in a results file, or 0 if it has none.
+
+    A killed run can leave a torn last line behind the write buffer; it is cut
+    off so the record is crawled again and appends start on a clean line.
+    """
+    while tail := last_line(path):
+        try:
+            return orjson.loads(tail).get("q_id", 0)
+        except orjson.JSONDecodeError:
+            print(f"Dropping torn last line of {path}")
+            with open(path, "r+b") as f:
+                size = f.seek(0, os.SEEK_END)
+                f.seek(max(0, size - len(tail) - 2))
+                end = f.read()
+                f.truncate(size - len(end) + end.rfind(tail))
+    return 0
+
+
 def has_allowed_cwe(cwe_texts):
     """Return True if any CWE text contains an allowed CWE ID."""
-    for t in cwe_texts:
-        m = re.search(r"CWE-(\d+)", t)
-        if m and m.group(1) in ALLOWED_CWE_IDS:
-            return True
-    return False
+    return any((m := CWE_RE.search(t)) and int(m.group(1)) in ALLOWED_CWE_INTS for t in cwe_texts)
+
+
+# Headers that never change between requests; set once on the session
+MEND_HEADERS = MappingProxyType({
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "en-US,en;q=0.9,zh-CN;q=0.8,zh;q=0.7",
+    "Upgrade-Insecure-Requests": "1",
+})
+
+# A few common desktop browsers
+_UAS = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 Safari/605.1.15",
+    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:125.0) Gecko/20100101 Firefox/125.0",
+)
 
 
 def _build_headers(referer: Optional[str] = None) -> dict:
-    uas = [
-        # A few common desktop browsers
-        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0 Safari/537.36",
-        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 Safari/605.1.15",
-        "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36",
-        "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:125.0) Gecko/20100101 Firefox/125.0",
-    ]
-    hdrs = {
-        "User-Agent": random.choice(uas),
-        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-        "Accept-Language": "en-US,en;q=0.9,zh-CN;q=0.8,zh;q=0.7",
-        "Connection": "keep-alive",
-        "Cache-Control": "no-cache",
-        "Pragma": "no-cache",
-        "Upgrade-Insecure-Requests": "1",
+    """Per-request headers layered on top of MEND_HEADERS."""
+    return {
+        "User-Agent": _UAS[random.randrange(len(_UAS))],
+        "Referer": referer or "https://www.mend.io/vulnerability-database/",
     }
-    if referer:
-        hdrs["Referer"] = referer
-    else:
-        hdrs["Referer"] = "https://www.mend.io/vulnerability-database/"
-    return hdrs
 
 
-def get_soup(url: str, referer: Optional[str] = None, max_retries: int = 5, base_delay: float = 0.5):
-    """Fetch URL with headers + retries/backoff and return BeautifulSoup object, or None on failure."""
-    last_exc = None
-    for attempt in range(max_retries):
-        try:
-            req = Request(url, headers=_build_headers(referer))
-            with urlopen(req, timeout=20) as resp:
-                data = resp.read()
-            return BeautifulSoup(data, "html.parser")
-        except HTTPError as e:
-            last_exc = e
-            # Back off more on 403/429
-            if e.code in (403, 429):
-                sleep_s = base_delay * (2 ** attempt) + random.uniform(0.25, 0.45)
-                time.sleep(sleep_s)
-                continue
-            else:
-                time.sleep(attempt * 0.2)
-                continue
-        except URLError as e:
-            last_exc = e
-            time.sleep(base_delay + attempt)
-            continue
-        except Exception as e:
-            last_exc = e
-            time.sleep(0.2)
-            continue
-    print(f"Fetch failed after retries: {url} -> {last_exc}")
-    return None
+def mend_session():
+    """Return a pooled keep-alive, disk-cached session for www.mend.io, meant to be shared by every month."""
+    connector = aiohttp.TCPConnector(limit_per_host=CONCURRENCY, ttl_dns_cache=300, keepalive_timeout=60)
+    # Month processes share the cache file, so wait on SQLite's lock instead of failing
+    cache = SQLiteBackend(
+        MEND_CACHE, expire_after=MEND_CACHE_TTL, allowed_codes=(200,), allowed_methods=("GET",), timeout=30
+    )
+    return CachedSession(
+        cache=cache, headers=MEND_HEADERS, connector=connector, timeout=aiohttp.ClientTimeout(total=20)
+    )
+
+
+async def prune_mend_cache():
+    """Delete expired pages from the Mend cache.
+
+    Most cached detail pages are CVEs the filter drops and are never read
+    again, and the cache only removes an expired entry when it is read.
+    """
+    async with mend_session() as session:
+        await session.cache.delete_expired_responses()
+
+
+def github_session():
+    """Return a pooled keep-alive session for api.github.com with auth headers set once."""
+    if not GITHUB_TOKEN:
+        # Unauthenticated calls would all come back 401 and land in the error files
+        raise RuntimeError("GITHUB_TOKEN is not set; export a GitHub personal access token first")
+    headers = {**GITHUB_HEADERS, "Authorization": f"Bearer {GITHUB_TOKEN}"}
+    connector = aiohttp.TCPConnector(limit_per_host=GITHUB_CONCURRENCY, ttl_dns_cache=300, keepalive_timeout=60)
+    return aiohttp.ClientSession(
+        headers=headers, connector=connector, timeout=aiohttp.ClientTimeout(total=20)
+    )
+
+
+def _retry_after(headers) -> Optional[float]:
+    """Parse a Retry-After header (delta-seconds or HTTP-date) into seconds from now."""
+    value = headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# Month processes still running, shared by the pool; None outside a pool
+_ACTIVE_WORKERS = None
+
+
+def _worker_share() -> float:
+    """Fraction of a host's budget this process may use."""
+    if _ACTIVE_WORKERS is None:
+        return 1.0
+    return 1.0 / max(1, _ACTIVE_WORKERS.value)
+
+
+class RateLimiter:
+    """Token bucket shared by every request to one host.
+
+    ``rate`` is the host's budget across all month processes; each process
+    refills its tokens at its share of it, up to ``burst``. ``penalize`` blocks
+    the bucket until a server-given deadline, and ``update`` retunes the rate
+    from the server's quota headers: full speed while more than ``reserve``
+    requests are left, spread over the rest of the window below that. No lock
+    is needed: ``_reserve`` never awaits, so it runs atomically on the event loop.
+    """
+
+    def __init__(self, rate_per_s: float, burst: int = 1, reserve: int = 0):
+        self.max_rate = rate_per_s
+        self.rate = rate_per_s
+        self.burst = burst
+        self.reserve = reserve
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._blocked_until = 0.0
+
+    def _reserve(self) -> float:
+        """Take one token and return how long the caller has to wait for it."""
+        now = time.monotonic()
+        rate = self.rate * _worker_share()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * rate)
+        self._last = now
+        self._tokens -= 1
+        wait = -self._tokens / rate if self._tokens < 0 else 0.0
+        return max(wait, self._blocked_until - now)
+
+    async def acquire(self):
+        delay = self._reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def refund(self):
+        """Give back a token that was taken for a request that never reached the server."""
+        self._tokens = min(self.burst, self._tokens + 1)
+
+    def penalize(self, delay: float):
+        """Hold every caller until ``delay`` seconds from now."""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+
+    def update(self, headers):
+        """Self-tune from Retry-After / X-RateLimit-Remaining / X-RateLimit-Reset."""
+        delay = _retry_after(headers)
+        if delay is not None:
+            self.penalize(delay)
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset = headers.get("X-RateLimit-Reset")
+        if remaining is None or reset is None:
+            return
+        window = max(1.0, int(reset) - time.time())
+        remaining = int(remaining)
+        if remaining == 0:
+            self.penalize(window)
+        elif remaining > self.reserve:
+            # The quota refills in full at reset, so there is no point stretching it
+            self.rate = self.max_rate
+        else:
+            self.rate = min(self.max_rate, remaining / window)
+
+
+# Per process; each month process draws its share of the host's budget
+LIMITERS = {
+    "www.mend.io": RateLimiter(MEND_RATE, burst=CONCURRENCY),
+    # Authenticated REST quota is 5000/hour; paced from the response headers once it runs low
+    "api.github.com": RateLimiter(GITHUB_RATE, burst=GITHUB_CONCURRENCY, reserve=GITHUB_RESERVE),
+}
 
 
-def step_one(Year, Month):
+def limiter_for(url: str) -> RateLimiter:
+    host = urlparse(url).netloc
+    if host not in LIMITERS:
+        LIMITERS[host] = RateLimiter(MEND_RATE, burst=CONCURRENCY)
+    return LIMITERS[host]
+
+
+def _giveup(e) -> bool:
+    """Only retry HTTP errors that are worth retrying; network errors always are."""
+    return isinstance(e, aiohttp.ClientResponseError) and e.status not in RETRY_STATUSES
+
+
+@backoff.on_exception(
+    backoff.expo,
+    (aiohttp.ClientError, asyncio.TimeoutError),
+    max_tries=5,
+    jitter=backoff.full_jitter,
+    giveup=_giveup,
+    factor=0.5,
+)
+async def _do_get(session, url: str, referer: Optional[str] = None, expire_after=None, revalidate=False) -> bytes:
+    limiter = limiter_for(url)
+    # Whether an entry is still fresh is only known after the lookup, so take a
+    # token up front and hand it back on a cache hit
+    await limiter.acquire()
+    async with session.get(
+        url, headers=_build_headers(referer), expire_after=expire_after, refresh=revalidate
+    ) as resp:
+        validated = "ETag" in resp.headers or "Last-Modified" in resp.headers
+        # A revalidated page is from_cache too, but its conditional GET did reach the server
+        if resp.from_cache and not (revalidate and validated):
+            limiter.refund()
+        if resp.status in (403, 429):
+            # Hold the whole host, not just this request
+            limiter.penalize(_retry_after(resp.headers) or 1.0)
+        resp.raise_for_status()
+        data = await resp.read()
+        if revalidate and validated and not resp.from_cache:
+            # It can always be revalidated, so keep it past MEND_CACHE_TTL
+            await session.cache.save_response(resp, session.cache.create_key("GET", url), None)
+        return data
+
+
+async def fetch(session, url: str, referer: Optional[str] = None, expire_after=None, revalidate=False):
+    """Fetch URL and return the response body, or None once retries are exhausted.
+
+    ``expire_after=0`` bypasses the disk cache for pages that must be live.
+    ``revalidate=True`` keeps a page that carries an ETag or Last-Modified with
+    no expiry and checks it with a conditional GET on every use, reusing it on
+    304 Not Modified; pages without a validator expire after MEND_CACHE_TTL.
+    """
+    try:
+        return await _do_get(session, url, referer, expire_after, revalidate)
+    except Exception as e:
+        print(f"Fetch failed after retries: {url} -> {e}")
+        return None
+
+
+async def get_tree(session, url: str, referer: Optional[str] = None, expire_after=None, revalidate=False):
+    """Fetch URL and return the parsed lxml tree, or None on failure."""
+    data = await fetch(session, url, referer, expire_after, revalidate)
+    if data is None:
+        return None
+    try:
+        return lxml.html.fromstring(data)
+    except ParserError as e:
+        # e.g. an empty body
+        print(f"Parse failed: {url} -> {e}")
+        return None
+
+
+def parse_detail(html_bytes) -> Optional[dict]:
+    """Extract the CVE fields of a Mend detail page with a single lexbor parse.
+
+    Returns None as soon as the page is known to be dropped: the CWE filter
+    runs first, then the cheap required fields (date, language, references),
+    and only pages that pass both get the description/CVSS extraction.
+    """
+    tree = LexborHTMLParser(html_bytes)
+    cwe_numbers = [a.text() for a in tree.css(SELECTORS["cwe"]) if "CWE" in a.text()]
+    if not has_allowed_cwe(cwe_numbers):
+        return None
+
+    one_res = {
+        "language": None,
+        "date": None,
+        "resources": [],
+        "CWEs": cwe_numbers,
+        "cvss": "",
+        "description": None,
+        "AV": None,
+        "AC": None,
+        "PR": None,
+        "UI": None,
+        "S": None,
+        "C": None,
+        "I": None,
+        "A": None,
+    }
+
+    for tag in tree.css(SELECTORS["h4"]):
+        text = tag.text()
+        if "Date:" in text:
+            one_res["date"] = text.strip().replace("Date:", "").strip()
+        elif "Language:" in text:
+            one_res["language"] = text.strip().replace("Language:", "").strip()
+    if not (one_res["date"] and one_res["language"]):
+        return None
+
+    # lexbor gives None for a bare <a href>; keep "" like BeautifulSoup did
+    one_res["resources"] = [a.attributes.get("href") or "" for a in tree.css(SELECTORS["refs"])]
+    if not one_res["resources"]:
+        return None
+
+    desc = tree.css_first(SELECTORS["desc"]) or tree.css_first(SELECTORS["desc_fallback"])
+    if desc:
+        one_res["description"] = desc.text().strip()
+
+    label = tree.css_first(SELECTORS["score"])
+    if label:
+        one_res["cvss"] = label.text().strip()
+
+    table = tree.css_first(SELECTORS["table"])
+    if table:
+        for tr in table.css(SELECTORS["tr"]):
+            th = tr.css_first(SELECTORS["th"]).text().strip()
+            td = tr.css_first(SELECTORS["td"]).text().strip()
+            if "Attack Vector" in th:
+                one_res["AV"] = td
+            elif "Attack Complexity" in th:
+                one_res["AC"] = td
+            elif "Privileges Required" in th:
+                one_res["PR"] = td
+            elif "User Interaction" in th:
+                one_res["UI"] = td
+            elif "Scope" in th:
+                one_res["S"] = td
+            elif "Confidentiality" in th:
+                one_res["C"] = td
+            elif "Integrity" in th:
+                one_res["I"] = td
+            elif "Availability" in th:
+                one_res["A"] = td
+
+    return one_res
+
+
+async def step_one(session, Year, Month, on_record=None):
     YM = f"{Year}_{Month}"
     ensure_dirs(["logs", "results"])
     filename = f"logs/{YM}.log"
     res_filename = f"results/{YM}.jsonl"
 
+    sem = asyncio.Semaphore(CONCURRENCY)
+
     if not os.path.exists(filename):
+        # A past month's listing rarely changes: revalidate its cached pages with a
+        # conditional GET, so a re-crawl costs a 304 per page. The current month's
+        # listing still grows and a future one may not exist yet, so both bypass the cache.
+        now = time.localtime()
+        if (int(Year), int(Month)) < (now.tm_year, now.tm_mon):
+            listing_cache = {"revalidate": True}
+        else:
+            listing_cache = {"expire_after": 0}
+
         url = f"https://www.mend.io/vulnerability-database/full-listing/{Year}/{Month}"
-        soup = get_soup(url)
-        if soup is None:
+        tree = await get_tree(session, url, **listing_cache)
+        if tree is None:
             print(f"Skip {Year}-{Month}: initial page 403/failed")
             return
 
         links = []
         try:
-            max_pagenumber = int(soup.find_all("li", class_="vuln-pagination-item")[-2].text.strip())
+            max_pagenumber = int(LISTING_SELECTORS["pagination"](tree)[-2].text_content().strip())
         except Exception:
             max_pagenumber = 1
 
-        for link in soup.find_all("a", href=re.compile(r"^/vulnerability-database/CVE")):
-            links.append((link.text, link.get("href")))
+        for link in LISTING_SELECTORS["cve_a"](tree):
+            links.append((link.text_content(), link.get("href")))
+
+        async def fetch_page(i):
+            async with sem:
+                page_url = f"https://www.mend.io/vulnerability-database/full-listing/{Year}/{Month}/{i}"
+                return i, await get_tree(session, page_url, referer=url, **listing_cache)
 
         if max_pagenumber > 1:
-            for i in trange(2, max_pagenumber + 1, desc=f"Pages {YM}", unit="page"):
-                url = f"https://www.mend.io/vulnerability-database/full-listing/{Year}/{Month}/{i}"
-                soup = get_soup(url, referer=f"https://www.mend.io/vulnerability-database/full-listing/{Year}/{Month}")
-                if soup is None:
+            pages = await atqdm.gather(
+                *(fetch_page(i) for i in range(2, max_pagenumber + 1)), desc=f"Pages {YM}", unit="page"
+            )
+            for i, tree in pages:
+                if tree is None:
                     print(f"Skip page {i} for {Year}-{Month}: 403/failed")
                     continue
-                for link in soup.find_all("a", href=re.compile(r"^/vulnerability-database/CVE")):
-                    links.append((link.text, link.get("href")))
-                time.sleep(random.uniform(0.2, 0.5))
+                for link in LISTING_SELECTORS["cve_a"](tree):
+                    links.append((link.text_content(), link.get("href")))
 
         with open(filename, "w", encoding="utf-8") as f:
             for _, href in links:
                 f.write(href + "\n")
 
-    with open(filename, "r", encoding="utf-8") as f:
-        content = f.readlines()
-
     prefix = "https://www.mend.io"
 
     already_query_qid = 0
     if os.path.exists(res_filename):
-        with open(res_filename, "r", encoding="utf-8") as f2:
-            queried = f2.readlines()
-            already_query_qid = json.loads(queried[-1]).get("q_id", 0) if queried else 0
-            print(f"already query {already_query_qid}")
+        already_query_qid = resume_qid(res_filename)
+        print(f"already query {already_query_qid}")
+
+    async def process(i, cve_href):
+        fullweb_url = prefix + cve_href
+        data = await fetch(session, fullweb_url, referer=prefix + "/vulnerability-database/")
+        if data is None:
+            # If blocked for this item, skip silently
+            return None
 
-    for i in trange(len(content), desc=f"CVE details {YM}", unit="item"):
+        one_res = {"q_id": i, "cve_id": cve_href.split("/")[-1]}
         try:
-            time.sleep(random.uniform(0.1, 0.2))
-            one_res = {
-                "q_id": i,
-                "cve_id": content[i].strip().split("/")[-1],
-                "language": None,
-                "date": None,
-                "resources": [],
-                "CWEs": [],
-                "cvss": None,
-                "description": None,
-                "AV": None,
-                "AC": None,
-                "PR": None,
-                "UI": None,
-                "S": None,
-                "C": None,
-                "I": None,
-                "A": None,
-            }
+            detail = parse_detail(data)
+        except Exception as e:
+            print(e)
+            return None
+        # Filtered out by the allowed CWE list or missing a required field
+        if detail is None:
+            return None
+        one_res.update(detail)
+
+        if (
+            one_res["cve_id"]
+            and one_res["language"]
+            and one_res["date"]
+            and one_res["resources"]
+            and one_res["CWEs"]
+            and one_res["cvss"] is not None
+        ):
+            return one_res
+        return None
+
+    # Workers finish out of order; flush in q_id order so the last line
+    # of the results file stays a valid resume point. Only flush() writes,
+    # so one handle is held open for the whole month.
+    pending = {}
+    next_qid = already_query_qid + 1
+    bar = tqdm(desc=f"CVE details {YM}", unit="item")
+    out = open(res_filename, "ab", buffering=1 << 16)
+
+    def flush(i, one_res):
+        nonlocal next_qid
+        pending[i] = one_res
+        bar.update()
+        while next_qid in pending:
+            one_res = pending.pop(next_qid)
+            next_qid += 1
+            if one_res is not None:
+                out.write(orjson.dumps(one_res) + b"\n")
+
+    async def worker(lines):
+        # Workers share one iterator over the listing file, so it is streamed, never loaded whole
+        for i, line in lines:
             if i <= already_query_qid:
                 continue
+            one_res = await process(i, line.strip())
+            flush(i, one_res)
+            if one_res is not None and on_record is not None:
+                await on_record(one_res)
 
-            fullweb_url = prefix + content[i].strip()
-            soup = get_soup(fullweb_url, referer=prefix + "/vulnerability-database/")
-            if soup is None:
-                # If blocked for this item, skip silently
-                continue
-            time.sleep(random.uniform(0.2, 0.5))
-
-            date = None
-            language = None
-            for tag in soup.find_all(["h4"]):
-                if tag.name == "h4":
-                    if "Date:" in tag.text:
-                        date = tag.text.strip().replace("Date:", "").strip()
-                    elif "Language:" in tag.text:
-                        language = tag.text.strip().replace("Language:", "").strip()
-
-            desc_div = soup.find("div", class_="single-vuln-desc no-good-to-know") or soup.find(
-                "div", class_="single-vuln-desc"
-            )
-            if desc_div:
-                desc = desc_div.find("p")
-                if desc:
-                    one_res["description"] = desc.text.strip()
-
-            one_res["date"] = date
-            one_res["language"] = language
-
-            reference_links = []
-            for div in soup.find_all("div", class_="reference-row"):
-                for link in div.find_all("a", href=True):
-                    reference_links.append(link["href"])
-            one_res["resources"] = reference_links
-
-            severity_score = ""
-            div_score = soup.find("div", class_="ranger-value")
-            if div_score:
-                label = div_score.find("label")
-                if label:
-                    severity_score = label.text.strip()
-            one_res["cvss"] = severity_score
-
-            table = soup.find("table", class_="table table-report")
-            if table:
-                for tr in table.find_all("tr"):
-                    th = tr.find("th").text.strip()
-                    td = tr.find("td").text.strip()
-                    if "Attack Vector" in th:
-                        one_res["AV"] = td
-                    elif "Attack Complexity" in th:
-                        one_res["AC"] = td
-                    elif "Privileges Required" in th:
-                        one_res["PR"] = td
-                    elif "User Interaction" in th:
-                        one_res["UI"] = td
-                    elif "Scope" in th:
-                        one_res["S"] = td
-                    elif "Confidentiality" in th:
-                        one_res["C"] = td
-                    elif "Integrity" in th:
-                        one_res["I"] = td
-                    elif "Availability" in th:
-                        one_res["A"] = td
-
-            cwe_numbers = []
-            for div in soup.find_all("div", class_="light-box"):
-                for link in div.find_all("a", href=True):
-                    if "CWE" in link.text:
-                        cwe_numbers.append(link.text)
-            one_res["CWEs"] = cwe_numbers
-
-            # Filter by allowed CWE list
-            if not has_allowed_cwe(one_res["CWEs"]):
-                continue
+    with open(filename, "r", encoding="utf-8") as f:
+        lines = enumerate(f)
+        workers = [asyncio.create_task(worker(lines)) for _ in range(CONCURRENCY)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            # If one worker failed, stop the others before their output handle closes
+            for w in workers:
+                w.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            out.close()
+            bar.close()
+
+
+def commit_queries(CVE) -> list:
+    """GitHub REST URLs for the commits referenced by one CVE record."""
+    return [
+        res.replace("/commit/", "/commits/").replace("https://github.com/", "https://api.github.com/repos/")
+        for res in CVE.get("resources", [])
+        # Results written before bare hrefs became "" may hold None
+        if res and "commit" in res and "github" in res
+    ]
+
+
+@backoff.on_exception(
+    backoff.expo,
+    (aiohttp.ClientError, asyncio.TimeoutError),
+    max_tries=5,
+    jitter=backoff.full_jitter,
+    giveup=_giveup,
+    factor=0.5,
+)
+async def _github_get(gh, query):
+    limiter = limiter_for(query)
+    await limiter.acquire()
+    async with gh.get(query) as resp:
+        limiter.update(resp.headers)
+        if resp.status in RETRY_STATUSES:
+            if resp.status in (403, 429):
+                # Secondary rate limit; update() already honoured any Retry-After
+                limiter.penalize(_retry_after(resp.headers) or 1.0)
+            resp.raise_for_status()
+        # Anything else (e.g. 404/422 for a dead commit) is decoded and judged by the caller
+        return await resp.json(content_type=None, loads=orjson.loads)
+
+
+async def github_commit(gh, query):
+    """Fetch one commit from the GitHub REST API and return the decoded JSON, or None once retries are exhausted."""
+    try:
+        return await _github_get(gh, query)
+    except Exception as e:
+        print(e)
+        return None
 
-            if (
-                one_res["cve_id"]
-                and one_res["language"]
-                and one_res["date"]
-                and one_res["resources"]
-                and one_res["CWEs"]
-                and one_res["cvss"] is not None
-            ):
-                with open(res_filename, "a", encoding="utf-8") as f2:
-                    jsonobj = json.dumps(one_res, ensure_ascii=False)
-                    f2.write(jsonobj + "\n")
-        except Exception as e:
-            print(e)
 
+async def step_two(gh, Year, Month, produce=None):
+    """Query GitHub for every commit referenced by the month's kept CVEs.
 
-def step_two(Year, Month):
+    Commits go through a bounded queue drained by GITHUB_CONCURRENCY consumers.
+    Records already in results/{YM}.jsonl are queued first; ``produce``, if given,
+    is then awaited with the enqueue callback so step_one can feed newly kept
+    CVEs while the consumers are already querying GitHub. The patch and error
+    files are only written once the month has completed.
+    """
     YM = f"{Year}_{Month}"
     res_filename = f"results/{YM}.jsonl"
     patch_name = f"crawl_result/{YM}_patch.jsonl"
     error_file = f"crawl_result/{YM}_patch_error.txt"
     ensure_dirs(["crawl_result"])
 
-    if not os.path.exists(res_filename):
+    if produce is None and not os.path.exists(res_filename):
         return
 
-    CVES = [json.loads(line) for line in open(res_filename, "r", encoding="utf-8")]
-    querys = []
-    fetchs = []
-    for CVE in CVES:
-        for res in CVE.get("resources", []):
-            if "commit" in res and "github" in res:
-                querys.append(
-                    res.replace("/commit/", "/commits/").replace(
-                        "https://github.com/", "https://api.github.com/repos/"
-                    )
-                )
-    try:
-        errors = []
-        for query in querys:
+    # Keyed by (q_id, resource index) so the patch file keeps the results file order
+    results = {}
+    failed = {}
+    q = asyncio.Queue(maxsize=500)
+    bar = tqdm(desc=f"Commits {YM}", unit="commit")
+    # The same fixing commit is often referenced by several CVEs. merge.py pairs
+    # resources with patch entries by position, so every resource keeps its own
+    # entry; only the GitHub call is made once per commit and shared.
+    calls = {}
+
+    def commit_call(query):
+        # "#diff-..." anchors never reach the server, so they share the commit's call
+        url = query.split("#")[0]
+        if url not in calls:
+            calls[url] = asyncio.ensure_future(github_commit(gh, url))
+        return calls[url]
+
+    async def enqueue(CVE):
+        for j, query in enumerate(commit_queries(CVE)):
+            await q.put(((CVE["q_id"], j), query))
+
+    async def consumer():
+        while True:
+            key, query = await q.get()
             try:
-                output = subprocess.check_output(
-                    [
-                        "curl",
-                        "--request",
-                        "GET",
-                        "-H",
-                        "Authorization: Bearer TODO",
-                        "-H",
-                        "X-GitHub-Api-Version: 2022-11-28",
-                        "-u",
-                        "KEY:",
-                        query,
-                    ]
-                ).decode()
-                data = json.loads(output)
-            except Exception as e:
-                print(e)
-                continue
-            if all(k in data for k in ("url", "html_url", "commit", "files")):
-                fetchs.append(
-                    {
+                data = await commit_call(query)
+                if data is None:
+                    continue
+                if all(k in data for k in ("url", "html_url", "commit", "files")):
+                    results[key] = {
                         "url": data["url"],
                         "html_url": data["html_url"],
                         "message": data["commit"]["message"],
@@ -324,27 +682,98 @@ def step_two(Year, Month):
                         "commit_id": data["sha"],
                         "commit_date": data["commit"]["committer"]["date"],
                     }
+                else:
+                    print("Wrong! Data is NULL, see case ", query)
+                    failed[key] = query
+            except Exception as e:
+                print(e)
+            finally:
+                bar.update()
+                q.task_done()
+
+    consumers = [asyncio.create_task(consumer()) for _ in range(GITHUB_CONCURRENCY)]
+    try:
+        if os.path.exists(res_filename):
+            with open(res_filename, "rb") as f:
+                for line in f:
+                    try:
+                        CVE = orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        # Torn last line of a killed run; step_one cuts it and crawls that CVE again
+                        continue
+                    await enqueue(CVE)
+        if produce is not None:
+            await produce(enqueue)
+        await q.join()
+    finally:
+        for c in consumers:
+            c.cancel()
+        await asyncio.gather(*consumers, return_exceptions=True)
+        bar.close()
+
+    # Only reached when the month completed; the producer may have found no listing
+    if not os.path.exists(res_filename):
+        return
+
+    fetchs = [results[k] for k in sorted(results)]
+    errors = [failed[k] for k in sorted(failed)]
+    # Write then rename, so a kill mid-write never leaves a previous complete patch file truncated
+    with open(patch_name + ".tmp", "wb") as rf:
+        rf.write(orjson.dumps(fetchs, option=orjson.OPT_INDENT_2))
+    os.replace(patch_name + ".tmp", patch_name)
+    with open(error_file, "w", encoding="utf-8") as rf:
+        for err in errors:
+            rf.write(err + "\n")
+
+
+async def pipeline(pairs, position=None):
+    """Run step_one and step_two together, month by month, on one pair of sessions.
+
+    step_one is the producer: every CVE it keeps is handed straight to the
+    step_two consumers, so Mend crawling and GitHub querying overlap.
+    """
+    async with mend_session() as session, github_session() as gh:
+        for Year, Month in tqdm(pairs, desc="Months", position=position):
+            try:
+                await step_two(
+                    gh, Year, Month, produce=lambda enqueue: step_one(session, Year, Month, on_record=enqueue)
                 )
-            else:
-                print("Wrong! Data is NULL, see case ", query)
-                errors.append(query)
-            time.sleep(0.2)
+            except Exception as e:
+                # One bad month must not cost the rest of this chunk; a re-run resumes it
+                print(f"Month {Year}-{Month} failed: {e!r}")
+
+
+def _init_worker(active):
+    global _ACTIVE_WORKERS
+    _ACTIVE_WORKERS = active
+
+
+def _run_pipeline(worker):
+    """Process-pool entry point: one chunk of months on its own event loop (uvloop when available)."""
+    position, pairs = worker
+    try:
+        if uvloop is not None:
+            uvloop.run(pipeline(pairs, position))
+        else:
+            asyncio.run(pipeline(pairs, position))
     finally:
-        with open(patch_name, "w", encoding="utf-8") as rf:
-            rf.write(json.dumps(fetchs, indent=4, separators=(",", ": ")))
-        with open(error_file, "w", encoding="utf-8") as rf:
-            for err in errors:
-                rf.write(err + "\n")
+        # Hand this process's share of the rate budgets to the ones still running
+        if _ACTIVE_WORKERS is not None:
+            with _ACTIVE_WORKERS.get_lock():
+                _ACTIVE_WORKERS.value -= 1
+
 
 def main():
     Years = [str(year) for year in range(2024, 2026)]
     Months = [str(month) for month in range(1, 13)]
-    for Year in Years:
-        for Month in tqdm(Months):
-            step_one(Year, Month)
-    for Year in Years:
-        for Month in tqdm(Months):
-            step_two(Year, Month)
+    pairs = [(Year, Month) for Year in Years for Month in Months]
+    # One chunk per process, so each keeps its sessions (pooled connections, DNS) across months
+    chunks = [(i, pairs[i::MONTH_WORKERS]) for i in range(MONTH_WORKERS)]
+    active = multiprocessing.Value("i", len(chunks))
+    # Once per crawl, before the month processes start sharing the cache file
+    asyncio.run(prune_mend_cache())
+    with ProcessPoolExecutor(max_workers=MONTH_WORKERS, initializer=_init_worker, initargs=(active,)) as pp:
+        list(pp.map(_run_pipeline, chunks))
 
 
 if __name__ == "__main__":